@@ -4,19 +4,33 @@
 import os
 import re
 import sys
+import json
 import qlib
 import shutil
 import zipfile
 import requests
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from pathlib import Path
 from loguru import logger
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
 from qlib.utils import exists_qlib_data
 
+_VERSION_RE = re.compile(r"(\d+)\.+")
+# dataset version published for this qlib release, e.g. "0.9" for qlib 0.9.x, "latest" if it cannot be parsed
+_DATA_VERSION = ".".join(_VERSION_RE.findall(qlib.__version__)) or "latest"
+# characters which can not be used in Windows file names, replaced like `ZipFile.extract` does
+_WINDOWS_ILLEGAL_NAME_TABLE = str.maketrans(':<>|"?*', "_" * 7)
+
 
 class GetData:
     REMOTE_URL = "https://github.com/SunsetWolf/qlib_dataset/releases/download"
+    # number of ranges downloaded in parallel when the server supports range requests
+    DOWNLOAD_PARTS = 8
+    # upper bound of the unzip threads, every thread parses the central directory of the archive again
+    UNZIP_WORKERS = 8
 
     def __init__(self, delete_zip_file=False):
         """
@@ -27,6 +41,16 @@ class GetData:
             Whether to delete the zip file, value from True or False, by default False
         """
         self.delete_zip_file = delete_zip_file
+        # reuse the keep-alive connection between `check_dataset` and `download`
+        self._session = requests.Session()
+        self._session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=16,
+                max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+            ),
+        )
 
     def merge_remote_url(self, file_name: str):
         """
@@ -41,7 +65,7 @@ class GetData:
         """
         return f"{self.REMOTE_URL}/{file_name}" if "/" in file_name else f"{self.REMOTE_URL}/v0/{file_name}"
 
-    def download(self, url: str, target_path: [Path, str]):
+    def download(self, url: str, target_path: [Path, str], etag: str = None):
         """
         Download a file from the specified url.
 
@@ -51,25 +75,124 @@ class GetData:
             The url of the data.
         target_path: str
             The location where the data is saved, including the file name.
-        """
-        file_name = str(target_path).rsplit("/", maxsplit=1)[-1]
-        resp = requests.get(url, stream=True, timeout=60)
-        resp.raise_for_status()
-        if resp.status_code != 200:
-            raise requests.exceptions.HTTPError()
+        etag: str
+            The ETag of a previously downloaded copy, if the remote file has not changed, nothing is downloaded.
+            By default None
 
-        chunk_size = 1024
+        Returns
+        -------
+        The ETag of the downloaded file ("" if the server does not send one), None if the file has not changed.
+        """
+        target_path = Path(target_path)
+        chunk_size = 256 * 1024
         logger.warning(
             f"The data for the example is collected from Yahoo Finance. Please be aware that the quality of the data might not be perfect. (You can refer to the original data source: https://finance.yahoo.com/lookup.)"
         )
-        logger.info(f"{os.path.basename(file_name)} downloading......")
-        with tqdm(total=int(resp.headers.get("Content-Length", 0))) as p_bar:
-            with target_path.open("wb") as fp:
+        logger.info(f"{target_path.name} downloading......")
+        # ask for the first byte only: a 206 answer gives the file size and tells that ranges are supported
+        # the connection goes back to the session pool once the body has been consumed and the response is closed
+        headers = {"Range": "bytes=0-0", "Accept-Encoding": "identity"}
+        if etag:
+            headers["If-None-Match"] = etag
+        with self._session.get(url, headers=headers, stream=True, timeout=60) as resp:
+            if resp.status_code == 304:
+                return None
+            resp.raise_for_status()
+            etag = resp.headers.get("ETag", "")
+            content_range = resp.headers.get("Content-Range", "")
+            if resp.status_code == 200:
+                # the server ignores ranges and is already sending the whole file
+                self._download_stream(resp, target_path, chunk_size)
+                return etag
+            if resp.status_code != 206:
+                raise requests.exceptions.HTTPError(f"Unexpected status code {resp.status_code}: {url}", response=resp)
+            # consume the single byte, so that the connection can be reused
+            resp.content  # pylint: disable=W0104
+        if not content_range or content_range.endswith("/*"):
+            # the total size is unknown, the file cannot be split into ranges
+            with self._session.get(url, stream=True, timeout=60) as resp:
+                resp.raise_for_status()
+                if resp.status_code != 200:
+                    raise requests.exceptions.HTTPError(
+                        f"Unexpected status code {resp.status_code}: {url}", response=resp
+                    )
+                self._download_stream(resp, target_path, chunk_size)
+            return etag
+
+        # download the parts in parallel, each worker writes its own range of the preallocated file
+        total_size = int(content_range.rsplit("/", maxsplit=1)[-1])
+        with target_path.open("wb") as fp:
+            fp.truncate(total_size)
+        part_size = max(4 << 20, -(-total_size // self.DOWNLOAD_PARTS))
+        parts = [(start, min(start + part_size, total_size) - 1) for start in range(0, total_size, part_size)]
+        with tqdm(total=total_size, unit="B", unit_scale=True, mininterval=0.5) as p_bar:
+            with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+                list(
+                    executor.map(
+                        lambda _part: self._download_part(
+                            url, target_path, *_part, chunk_size, p_bar, etag=etag, total_size=total_size
+                        ),
+                        parts,
+                    )
+                )
+        return etag
+
+    @staticmethod
+    def _download_stream(resp: requests.Response, target_path: Path, chunk_size: int):
+        with tqdm(
+            total=int(resp.headers.get("Content-Length", 0)), unit="B", unit_scale=True, mininterval=0.5
+        ) as p_bar:
+            with target_path.open("wb", buffering=1 << 20) as fp:
                 for chunk in resp.iter_content(chunk_size=chunk_size):
                     fp.write(chunk)
-                    p_bar.update(chunk_size)
+                    p_bar.update(len(chunk))
 
-    def download_data(self, file_name: str, target_dir: [Path, str], delete_old: bool = True):
+    def _download_part(
+        self,
+        url: str,
+        target_path: Path,
+        start: int,
+        end: int,
+        chunk_size: int,
+        p_bar: tqdm,
+        etag: str,
+        total_size: int,
+    ):
+        headers = {"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"}
+        if etag and not etag.startswith("W/"):
+            # if the file has been republished since the probe, the server sends the whole new file with 200
+            headers["If-Range"] = etag
+        with self._session.get(url, headers=headers, stream=True, timeout=60) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise requests.exceptions.HTTPError(
+                    f"Unexpected status code {resp.status_code} for range {start}-{end}: {url}", response=resp
+                )
+            # all the parts must come from the same version of the file
+            if resp.headers.get("ETag", "") != etag or resp.headers.get("Content-Range") != (
+                f"bytes {start}-{end}/{total_size}"
+            ):
+                raise requests.exceptions.HTTPError(
+                    f"{url} has changed during the download, "
+                    f"ETag: {resp.headers.get('ETag')}, Content-Range: {resp.headers.get('Content-Range')}",
+                    response=resp,
+                )
+            size = 0
+            with target_path.open("r+b", buffering=1 << 20) as fp:
+                fp.seek(start)
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    fp.write(chunk)
+                    size += len(chunk)
+                    p_bar.update(len(chunk))
+            if size != end - start + 1:
+                raise requests.exceptions.HTTPError(
+                    f"Incomplete range {start}-{end} of {url}: {size} of {end - start + 1} bytes received",
+                    response=resp,
+                )
+
+    def download_data(
+        self, file_name: str, target_dir: [Path, str], delete_old: bool = True, force_download: bool = False
+    ):
         """
         Download the specified file to the target folder.
 
@@ -82,6 +205,10 @@ class GetData:
             may contain folder names, for example: v2/qlib_data_simple_cn_1d_latest.zip
         delete_old: bool
             delete an existing directory, by default True
+        force_download: bool
+            download the file even if it has not changed since the last download, by default False.
+            If the server reports that the file is unchanged (the ETag saved in `<target_dir>/<file_name>.etag` still matches),
+            the download is skipped and the data in target_dir is kept, `delete_old` has no effect in this case
 
         Examples
         ---------
@@ -98,37 +225,117 @@ class GetData:
         target_dir = Path(target_dir).expanduser()
         target_dir.mkdir(exist_ok=True, parents=True)
         # saved file name
-        _target_file_name = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + "_" + os.path.basename(file_name)
+        _target_file_name = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + "_" + Path(file_name).name
         target_path = target_dir.joinpath(_target_file_name)
 
+        # ETag of the data currently extracted in target_dir
+        etag_path = target_dir.joinpath(f"{Path(file_name).name}.etag")
+        etag = None if force_download else self._read_etag(etag_path, target_dir)
+
         url = self.merge_remote_url(file_name)
-        self.download(url=url, target_path=target_path)
+        etag = self.download(url=url, target_path=target_path, etag=etag)
+        if etag is None:
+            logger.warning(
+                f"{file_name} has not changed since the last download, the data in {target_dir} is kept\n"
+                f"\tIf downloading is required: `force_download=True`"
+            )
+            return
 
-        self._unzip(target_path, target_dir, delete_old)
+        infos = self._unzip(target_path, target_dir, delete_old)
         if self.delete_zip_file:
             target_path.unlink()
+        if etag:
+            # the top-level entries of the archive tell whether the extracted data is still there
+            member_paths = [self._get_member_path(Path(), _info.filename) for _info in infos]
+            paths = sorted({_path.parts[0] for _path in member_paths if _path.parts})
+            etag_path.write_text(json.dumps({"etag": etag, "paths": paths}))
+        elif etag_path.exists():
+            etag_path.unlink()
+
+    @staticmethod
+    def _read_etag(etag_path: Path, target_dir: Path):
+        """
+        Get the ETag of the data extracted in target_dir, None if it is unknown or the extracted data is missing.
+        """
+        if not etag_path.exists():
+            return None
+        try:
+            etag_info = json.loads(etag_path.read_text())
+            etag, paths = etag_info["etag"], etag_info["paths"]
+        except (ValueError, KeyError, TypeError):
+            etag, paths = None, []
+        if etag is None or not all(target_dir.joinpath(_path).exists() for _path in paths):
+            logger.warning(f"The data extracted in {target_dir} is incomplete, {etag_path} is ignored")
+            etag_path.unlink()
+            return None
+        return etag
 
     def check_dataset(self, file_name: str):
         url = self.merge_remote_url(file_name)
-        resp = requests.get(url, stream=True, timeout=60)
-        status = True
-        if resp.status_code == 404:
-            status = False
-        return status
+        # GitHub answers an existing release asset with a redirect to its storage, and a missing one with 404
+        resp = self._session.head(url, timeout=30, allow_redirects=False)
+        return resp.status_code != 404
 
     @staticmethod
-    def _unzip(file_path: [Path, str], target_dir: [Path, str], delete_old: bool = True):
+    def _unzip(file_path: [Path, str], target_dir: [Path, str], delete_old: bool = True) -> list:
+        """
+        Extract the archive to target_dir, return the `ZipInfo` of its members.
+        """
         file_path = Path(file_path)
-        target_dir = Path(target_dir)
+        target_dir = Path(target_dir).resolve()
         if delete_old:
             logger.warning(
                 f"will delete the old qlib data directory(features, instruments, calendars, features_cache, dataset_cache): {target_dir}"
             )
             GetData._delete_qlib_data(target_dir)
         logger.info(f"{file_path} unzipping......")
-        with zipfile.ZipFile(str(file_path.resolve()), "r") as zp:
-            for _file in tqdm(zp.namelist()):
-                zp.extract(_file, str(target_dir.resolve()))
+        with zipfile.ZipFile(file_path, "r") as zp:
+            infos = zp.infolist()
+        # create the parent directories up front, so that the workers do not race on `os.makedirs`
+        for _dir in {GetData._get_member_path(target_dir, _info.filename).parent for _info in infos}:
+            _dir.mkdir(parents=True, exist_ok=True)
+        max_workers = max(1, min(GetData.UNZIP_WORKERS, os.cpu_count() or 1, len(infos)))
+        # the progress is weighted by the uncompressed size of the members, which the central directory provides
+        with tqdm(total=sum(_info.file_size for _info in infos), unit="B", unit_scale=True, mininterval=0.5) as p_bar:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(
+                    executor.map(
+                        lambda _infos: GetData._extract_members(file_path, _infos, target_dir, p_bar),
+                        [infos[i::max_workers] for i in range(max_workers)],
+                    )
+                )
+        return infos
+
+    @staticmethod
+    def _extract_members(file_path: Path, infos: list, target_dir: Path, p_bar: tqdm):
+        # ZipFile is not safe for concurrent reads, each worker uses its own handle
+        with zipfile.ZipFile(file_path, "r") as zp:
+            for _info in infos:
+                _path = GetData._get_member_path(target_dir, _info.filename)
+                if _info.is_dir():
+                    _path.mkdir(parents=True, exist_ok=True)
+                else:
+                    # the parent directories have been created by `_unzip`
+                    with zp.open(_info) as src, _path.open("wb") as dst:
+                        shutil.copyfileobj(src, dst, length=1 << 20)
+                p_bar.update(_info.file_size)
+
+    @staticmethod
+    def _get_member_path(target_dir: Path, name: str) -> Path:
+        """
+        Get the extraction path of the member, sanitized in the same way as `ZipFile.extract`:
+        drive, absolute and ".." parts are removed, and on Windows the illegal characters are replaced by "_"
+        and the trailing dots of each part are removed.
+        """
+        name = name.replace("/", os.path.sep)
+        if os.path.altsep:
+            name = name.replace(os.path.altsep, os.path.sep)
+        name = os.path.splitdrive(name)[1]
+        parts = [x for x in name.split(os.path.sep) if x not in ("", os.path.curdir, os.path.pardir)]
+        if os.path.sep == "\\":
+            parts = [x.translate(_WINDOWS_ILLEGAL_NAME_TABLE).rstrip(".") for x in parts]
+            parts = [x for x in parts if x]
+        return target_dir.joinpath(*parts)
 
     @staticmethod
     def _delete_qlib_data(file_dir: Path):
@@ -148,7 +355,8 @@ class GetData:
                 sys.exit()
             for _p in rm_dirs:
                 logger.warning(f"delete: {_p}")
-                shutil.rmtree(_p)
+            with ThreadPoolExecutor(max_workers=len(rm_dirs)) as executor:
+                list(executor.map(shutil.rmtree, rm_dirs))
 
     def qlib_data(
         self,
@@ -159,6 +367,7 @@ class GetData:
         region="cn",
         delete_old=True,
         exists_skip=False,
+        force_download=False,
     ):
         """download cn qlib data from remote
 
@@ -178,6 +387,9 @@ class GetData:
             delete an existing directory, by default True
         exists_skip: bool
             exists skip, by default False
+        force_download: bool
+            download the data even if it has not changed since the last download, by default False.
+            Otherwise the download is skipped when the server reports that the data is unchanged, `delete_old` has no effect in this case
 
         Examples
         ---------
@@ -188,6 +400,9 @@ class GetData:
         # get 1min data
         python get_data.py qlib_data --name qlib_data --target_dir ~/.qlib/qlib_data/cn_data_1min --interval 1min --region cn
         When this command is run, the data will be downloaded from this link: https://qlibpublic.blob.core.windows.net/data/default/stock_data/v2/qlib_data_cn_1min_latest.zip?{token}
+
+        # download again even if the data has not changed
+        python get_data.py qlib_data --name qlib_data --target_dir ~/.qlib/qlib_data/cn_data --interval 1d --region cn --force_download True
         -------
 
         """
@@ -198,14 +413,12 @@ class GetData:
             )
             return
 
-        qlib_version = ".".join(re.findall(r"(\d+)\.+", qlib.__version__))
-
         def _get_file_name_with_version(qlib_version, dataset_version):
             dataset_version = "v2" if dataset_version is None else dataset_version
             file_name_with_version = f"{dataset_version}/{name}_{region.lower()}_{interval.lower()}_{qlib_version}.zip"
             return file_name_with_version
 
-        file_name = _get_file_name_with_version(qlib_version, dataset_version=version)
+        file_name = _get_file_name_with_version(_DATA_VERSION, dataset_version=version)
         if not self.check_dataset(file_name):
             file_name = _get_file_name_with_version("latest", dataset_version=version)
-        self.download_data(file_name.lower(), target_dir, delete_old)
+        self.download_data(file_name.lower(), target_dir, delete_old, force_download=force_download)
@@ -0,0 +1,272 @@
+#  Copyright (c) Microsoft Corporation.
+#  Licensed under the MIT License.
+
+import os
+import re
+import ntpath
+import shutil
+import zipfile
+import hashlib
+import threading
+import unittest
+import http.server
+from unittest import mock
+from types import SimpleNamespace
+from pathlib import Path
+from pathlib import PureWindowsPath
+
+import requests
+from qlib.tests.data import GetData
+
+DATA_DIR = Path(__file__).parent.joinpath("test_get_data_local")
+
+
+class _RemoteHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the files of `server.root`, the behaviour is controlled by the attributes of the server"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._send(head=True)
+
+    def do_GET(self):
+        self._send()
+
+    def _send(self, head=False):
+        self.server.requests.append((self.command, self.headers.get("Range")))
+        path = self.server.root.joinpath(self.path.lstrip("/"))
+        if self.server.status is not None or not path.is_file():
+            self._send_response(self.server.status or 404, {}, b"", head)
+            return
+        data = path.read_bytes()
+        headers = {"ETag": f'"{hashlib.md5(data).hexdigest()}"'}
+        if not self.server.etag:
+            headers.pop("ETag")
+        elif self.headers.get("If-None-Match") == headers["ETag"]:
+            self._send_response(304, headers, b"", head)
+            return
+        status = 200
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if self.server.ranges and match:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(data) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{'*' if self.server.unknown_size else len(data)}"
+            data = data[start : end + 1]
+            if start > 0 and self.server.changed_parts:
+                headers["ETag"] = '"changed"'
+            if start > 0 and self.server.truncated_parts:
+                data = data[:-1]
+            status = 206
+        self._send_response(status, headers, data, head)
+
+    def _send_response(self, status, headers, data, head):
+        self.send_response(status)
+        for _key, _value in headers.items():
+            self.send_header(_key, _value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+
+class _Progress:
+    """Record the total and the updates of the progress bar"""
+
+    instances = []
+
+    def __init__(self, total=None, **kwargs):
+        self.total = total
+        self.n = 0
+        self._lock = threading.Lock()
+        self.instances.append(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def update(self, n=1):
+        with self._lock:
+            self.n += n
+
+
+class TestGetDataLocal(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.remote_dir = DATA_DIR.joinpath("remote")
+        cls.remote_dir.joinpath("v0").mkdir(parents=True, exist_ok=True)
+        # large enough to be split into several ranges
+        cls.remote_dir.joinpath("v0", "data.bin").write_bytes(os.urandom(9 * 1024 * 1024 + 123))
+
+        cls.source_dir = DATA_DIR.joinpath("source")
+        for _i in range(50):
+            _path = cls.source_dir.joinpath("features", f"sh{_i:06d}", "close.day.bin")
+            _path.parent.mkdir(parents=True, exist_ok=True)
+            _path.write_bytes(os.urandom(100 + _i * 37))
+        cls.source_dir.joinpath("calendars").mkdir(parents=True, exist_ok=True)
+        # larger than the copy buffer
+        cls.source_dir.joinpath("calendars", "day.txt").write_bytes(os.urandom(3 * 1024 * 1024))
+        with zipfile.ZipFile(cls.remote_dir.joinpath("v0", "data.zip"), "w", zipfile.ZIP_DEFLATED) as zp:
+            zp.writestr("instruments/", "")
+            for _path in sorted(cls.source_dir.rglob("*")):
+                if _path.is_file():
+                    zp.write(_path, _path.relative_to(cls.source_dir).as_posix())
+
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RemoteHandler)
+        cls.server.daemon_threads = True
+        cls.server.root = cls.remote_dir
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(str(DATA_DIR.resolve()))
+
+    def setUp(self) -> None:
+        self.server.requests = []
+        self.server.status = None
+        self.server.ranges = True
+        self.server.unknown_size = False
+        self.server.changed_parts = False
+        self.server.truncated_parts = False
+        self.server.etag = True
+        self.target_dir = DATA_DIR.joinpath("target")
+        shutil.rmtree(self.target_dir, ignore_errors=True)
+        self.target_dir.mkdir(parents=True)
+        self.get_data = GetData()
+        self.get_data.REMOTE_URL = f"http://127.0.0.1:{self.server.server_port}"
+
+    def _download(self):
+        target_path = self.target_dir.joinpath("data.bin")
+        self.get_data.download(self.get_data.merge_remote_url("data.bin"), target_path)
+        return target_path
+
+    def _assert_same_tree(self, left: Path, right: Path):
+        left_files = sorted(_p.relative_to(left) for _p in left.rglob("*"))
+        right_files = sorted(_p.relative_to(right) for _p in right.rglob("*"))
+        self.assertListEqual(left_files, right_files)
+        for _path in left_files:
+            if left.joinpath(_path).is_file():
+                self.assertEqual(left.joinpath(_path).read_bytes(), right.joinpath(_path).read_bytes(), _path)
+
+    def test_check_dataset(self):
+        self.assertTrue(self.get_data.check_dataset("data.zip"))
+        self.assertFalse(self.get_data.check_dataset("missing.zip"))
+        self.assertListEqual([_r[0] for _r in self.server.requests], ["HEAD", "HEAD"])
+        # only 404 means that the dataset does not exist
+        self.server.status = 500
+        self.assertTrue(self.get_data.check_dataset("data.zip"))
+
+    def test_download_ranges(self):
+        target_path = self._download()
+        self.assertEqual(target_path.read_bytes(), self.remote_dir.joinpath("v0", "data.bin").read_bytes())
+        self.assertGreater(len([_r for _r in self.server.requests if _r[1] not in (None, "bytes=0-0")]), 1)
+
+    def test_download_without_ranges(self):
+        self.server.ranges = False
+        target_path = self._download()
+        self.assertEqual(target_path.read_bytes(), self.remote_dir.joinpath("v0", "data.bin").read_bytes())
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_download_unknown_size(self):
+        self.server.unknown_size = True
+        target_path = self._download()
+        self.assertEqual(target_path.read_bytes(), self.remote_dir.joinpath("v0", "data.bin").read_bytes())
+
+    def test_download_changed_file(self):
+        self.server.changed_parts = True
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self._download()
+
+    def test_download_incomplete_part(self):
+        self.server.truncated_parts = True
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self._download()
+
+    def test_unzip(self):
+        GetData._unzip(self.remote_dir.joinpath("v0", "data.zip"), self.target_dir, delete_old=False)
+        self.assertTrue(self.target_dir.joinpath("instruments").is_dir())
+        self.target_dir.joinpath("instruments").rmdir()
+        self._assert_same_tree(self.source_dir, self.target_dir)
+
+    def test_unzip_progress(self):
+        _Progress.instances = []
+        with mock.patch("qlib.tests.data.tqdm", _Progress):
+            GetData._unzip(self.remote_dir.joinpath("v0", "data.zip"), self.target_dir, delete_old=False)
+        total_size = sum(_p.stat().st_size for _p in self.source_dir.rglob("*") if _p.is_file())
+        self.assertEqual(len(_Progress.instances), 1)
+        self.assertEqual(_Progress.instances[0].total, total_size)
+        self.assertEqual(_Progress.instances[0].n, total_size)
+
+    def test_download_data_not_modified(self):
+        self.get_data.download_data("data.zip", self.target_dir, delete_old=False)
+        self._assert_same_tree(self.source_dir.joinpath("features"), self.target_dir.joinpath("features"))
+        self.assertTrue(self.target_dir.joinpath("data.zip.etag").exists())
+
+        self.server.requests = []
+        self.get_data.download_data("data.zip", self.target_dir, delete_old=False)
+        # answered by 304, nothing is downloaded
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_download_data_missing_tree(self):
+        self.get_data.download_data("data.zip", self.target_dir, delete_old=False)
+        shutil.rmtree(self.target_dir.joinpath("features"))
+
+        self.server.requests = []
+        self.get_data.download_data("data.zip", self.target_dir, delete_old=False)
+        self.assertGreater(len(self.server.requests), 1)
+        self.assertTrue(self.target_dir.joinpath("features").exists())
+        self.assertTrue(self.target_dir.joinpath("data.zip.etag").exists())
+
+    def test_download_data_without_etag(self):
+        etag_path = self.target_dir.joinpath("data.zip.etag")
+        etag_path.write_text("invalid")
+        self.server.etag = False
+        self.get_data.download_data("data.zip", self.target_dir, delete_old=False)
+        self.assertFalse(etag_path.exists())
+        self.assertTrue(self.target_dir.joinpath("features").exists())
+
+    def test_download_data_force(self):
+        self.get_data.download_data("data.zip", self.target_dir, delete_old=False)
+        self.target_dir.joinpath("calendars", "day.txt").write_text("modified")
+
+        self.server.requests = []
+        self.get_data.download_data("data.zip", self.target_dir, delete_old=False, force_download=True)
+        self.assertGreater(len(self.server.requests), 1)
+        self.assertEqual(
+            self.target_dir.joinpath("calendars", "day.txt").read_bytes(),
+            self.source_dir.joinpath("calendars", "day.txt").read_bytes(),
+        )
+
+    def test_member_path(self):
+        names = ["../x.txt", "../../y/z.txt", "/abs/a.txt", "C:\\c.txt", "C:/d.txt", "e/./f/../g.txt", "h\\..\\i.txt"]
+        target_dir = self.target_dir.resolve()
+        for _name in names:
+            _path = GetData._get_member_path(target_dir, _name)
+            self.assertIn(target_dir, _path.parents, _name)
+            with zipfile.ZipFile(DATA_DIR.joinpath("member.zip"), "w") as zp:
+                zp.writestr(_name, "1")
+            with zipfile.ZipFile(DATA_DIR.joinpath("member.zip"), "r") as zp:
+                self.assertEqual(Path(zp.extract(_name, target_dir)), _path, _name)
+
+    def test_member_path_windows(self):
+        names = {
+            "../x.txt": "x.txt",
+            "C:\\y\\z.txt": "y\\z.txt",
+            "..\\..\\a.txt": "a.txt",
+            'b/c:d?"e*.txt': "b\\c_d__e_.txt",
+            "f<g>|h/i.": "f_g__h\\i",
+            "j/.../k.txt": "j\\k.txt",
+        }
+        target_dir = PureWindowsPath("D:\\qlib_data")
+        with mock.patch("qlib.tests.data.os", SimpleNamespace(path=ntpath)):
+            for _name, _expected in names.items():
+                self.assertEqual(GetData._get_member_path(target_dir, _name), target_dir.joinpath(_expected), _name)
+
+
+if __name__ == "__main__":
+    unittest.main()